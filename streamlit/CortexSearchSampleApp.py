@@ -15,8 +15,11 @@
 # - 2025/10/06 Final Update
 # ------------------------------------------------------------
 
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 import streamlit as st
 from snowflake.snowpark.context import get_active_session
@@ -33,21 +36,45 @@ MODELS = [
     "llama4-scout",
 ]
 MANUAL_SENTINEL = "<手入力>"
-
-# Snowflake接続
-session = get_active_session()
-root = Root(session)
+DEFAULT_REQUEST_COLUMNS = ["chunk", "file_url", "relative_path"]
+# 履歴に保持するチャンク本文の最大文字数（全文はその回のプロンプト/表示にのみ使用）
+HISTORY_CHUNK_CHARS = 400
+# 保持する最大ターン数
+MAX_HISTORY = 100
+# 回答キャッシュの最大件数（モデル×プロンプト単位）
+COMPLETION_CACHE_SIZE = 256
+# 回答キャッシュの有効期間（秒, エントリ単位）
+COMPLETION_CACHE_TTL = 3600
+# フィルタ候補値の最大件数（SQL 文面を固定して Snowflake の結果キャッシュを効かせる。
+# USE_CACHED_RESULT=TRUE（既定）のままにしておくこと）
+DISTINCT_LIMIT = 200
+# サービス一覧取得時に DESCRIBE まで先読みするサービス数の上限
+DESCRIBE_PREFETCH_LIMIT = 8
+
+# Snowflake接続（再実行間で共有）
+@st.cache_resource
+def get_session():
+    return get_active_session()
+
+
+@st.cache_resource
+def get_root() -> Root:
+    return Root(get_session())
 
 
 # ---------- ユーティリティ ----------
 
-def df_rows_to_dicts(rows, cols) -> List[Dict[str, Any]]:
+def df_rows_to_dicts(df) -> List[Dict[str, Any]]:
     def norm(k: str) -> str:
         s = str(k or "").strip()
         if s.startswith('"') and s.endswith('"'):
             s = s[1:-1]
         return s.lower()
-    return [{norm(cols[i]): r[i] for i in range(len(cols))} for r in rows]
+    pdf = df.to_pandas()
+    pdf.columns = [norm(c) for c in pdf.columns]
+    # NULL は None に揃える（NaN のままだと後段の `or ""` が効かない）
+    pdf = pdf.astype(object).where(pdf.notna(), None)
+    return pdf.to_dict(orient="records")
 
 
 def build_fq_name(db: str, schema: str, name: str) -> str:
@@ -67,34 +94,35 @@ def quote_ident(name: str) -> str:
     return f'"{s}"'
 
 
+@st.cache_data(ttl=300, show_spinner=False)
 def list_databases() -> List[str]:
-    df = session.sql("SHOW DATABASES;")
-    rows = df.collect()
-    cols = [f.name for f in df.schema.fields]
-    dicts = df_rows_to_dicts(rows, cols)
-    names: List[str] = []
-    for rd in dicts:
-        n = (rd.get("name") or rd.get("database_name") or "").strip()
-        if n and n not in names:
-            names.append(n)
-    return names
+    df = get_session().sql("SHOW DATABASES;")
+    dicts = df_rows_to_dicts(df)
+    names = ((rd.get("name") or rd.get("database_name") or "").strip() for rd in dicts)
+    return list(dict.fromkeys(n for n in names if n))
 
 
+@st.cache_data(ttl=300, show_spinner=False)
 def list_schemas(db: Optional[str]) -> List[str]:
     if not db:
         return []
-    df = session.sql(f"SHOW SCHEMAS IN DATABASE {quote_ident(db)};")
-    rows = df.collect()
-    cols = [f.name for f in df.schema.fields]
-    dicts = df_rows_to_dicts(rows, cols)
-    names: List[str] = []
-    for rd in dicts:
-        n = (rd.get("name") or rd.get("schema_name") or "").strip()
-        if n and n not in names:
-            names.append(n)
-    return names
+    df = get_session().sql(f"SHOW SCHEMAS IN DATABASE {quote_ident(db)};")
+    dicts = df_rows_to_dicts(df)
+    names = ((rd.get("name") or rd.get("schema_name") or "").strip() for rd in dicts)
+    return list(dict.fromkeys(n for n in names if n))
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _db_reachable(db: str) -> bool:
+    # 失敗も含めてキャッシュする（到達不可の DB に毎回 SHOW を投げない）
+    try:
+        list_schemas(db)
+        return True
+    except Exception:
+        return False
 
 
+@st.cache_data(ttl=300, show_spinner=False)
 def load_cortex_services(db_hint: Optional[str] = None, schema_hint: Optional[str] = None) -> List[Dict[str, Any]]:
     queries = []
     if db_hint and schema_hint:
@@ -104,48 +132,101 @@ def load_cortex_services(db_hint: Optional[str] = None, schema_hint: Optional[st
     queries.append("SHOW CORTEX SEARCH SERVICES;")
     queries.append("SHOW CORTEX SEARCH SERVICES IN ACCOUNT;")
 
+    session = get_session()
+
+    def run_show(q: str) -> List[Dict[str, Any]]:
+        return df_rows_to_dicts(session.sql(q))
+
     services: List[Dict[str, Any]] = []
     seen = set()
 
-    for q in queries:
-        df = session.sql(q)
-        rows = df.collect()
-        cols = [f.name for f in df.schema.fields]
-        dicts = df_rows_to_dicts(rows, cols)
-
-        for rd in dicts:
-            db = (rd.get("database_name") or rd.get("database") or "").strip()
-            schema = (rd.get("schema_name") or rd.get("schema") or "").strip()
-            name = (rd.get("name") or "").strip()
-            if not name:
-                continue
-
-            fq_name = build_fq_name(db, schema, name)
-            key = (db, schema, fq_name)
-            if key in seen:
-                continue
-            seen.add(key)
-
-            # 大文字/小文字は保持（フィルタ列名に使用）
-            search_col = (rd.get("search_column") or "chunk")
-            cols_raw = (rd.get("columns") or "")
-            cols_avail = [c.strip() for c in cols_raw.split(",") if c.strip()]
-
-            services.append({
-                "fq_name": fq_name,
-                "db": db,
-                "schema": schema,
-                "short_name": name.strip('"'),
-                "search_column": search_col,
-                "columns_available": cols_avail,
-            })
+    # 各 SHOW は独立した往復なので同時に発行し、結果は狭いスコープから順に採用
+    ex = ThreadPoolExecutor(max_workers=len(queries))
+    futures = [ex.submit(run_show, q) for q in queries]
+    try:
+        for fut in futures:
+            dicts = fut.result()
+
+            for rd in dicts:
+                db = (rd.get("database_name") or rd.get("database") or "").strip()
+                schema = (rd.get("schema_name") or rd.get("schema") or "").strip()
+                name = (rd.get("name") or "").strip()
+                if not name:
+                    continue
 
-        if services:
-            break
+                fq_name = build_fq_name(db, schema, name)
+                key = (db, schema, fq_name)
+                if key in seen:
+                    continue
+                seen.add(key)
+
+                # 大文字/小文字は保持（フィルタ列名に使用）
+                search_col = (rd.get("search_column") or "chunk")
+                cols_raw = (rd.get("columns") or "")
+                cols_avail = [c.strip() for c in cols_raw.split(",") if c.strip()]
+
+                services.append(with_request_columns({
+                    "fq_name": fq_name,
+                    "db": db,
+                    "schema": schema,
+                    "short_name": name.strip('"'),
+                    "search_column": search_col,
+                    "columns_available": cols_avail,
+                }))
+
+            if services:
+                break
+    finally:
+        # 採用済みなら残りの SHOW の完了は待たない
+        ex.shutdown(wait=False, cancel_futures=True)
+
+    # 先頭のサービス（既定の選択肢）の DESCRIBE もここでまとめて同時に取得しておく。
+    # それ以外は選択時に describe_cortex_service_properties で取得する
+    head = services[:DESCRIBE_PREFETCH_LIMIT]
+    if head:
+        with ThreadPoolExecutor(max_workers=len(head)) as ex:
+            props_list = list(ex.map(
+                lambda m: fetch_cortex_service_properties(session, m["db"], m["schema"], m["short_name"]),
+                head,
+            ))
+        for m, props in zip(head, props_list):
+            m["props"] = props
 
     return services
 
 
+def _clear_metadata_cache():
+    try:
+        list_databases.clear()
+        list_schemas.clear()
+        _db_reachable.clear()
+        load_cortex_services.clear()
+    except Exception:
+        pass
+
+
+SVC_CACHE_PREFIX = "_svc_cache::"
+
+
+def get_svc_handle(db: str, schema: str, short_name: str):
+    # サービスハンドルはセッション内で使い回す（毎ターンの解決を避ける）
+    key = f"{SVC_CACHE_PREFIX}{db}.{schema}.{short_name}"
+    if key not in st.session_state:
+        st.session_state[key] = get_root().databases[db].schemas[schema].cortex_search_services[short_name]
+    return st.session_state[key]
+
+
+def _clear_svc_handles():
+    for k in [k for k in st.session_state.keys() if str(k).startswith(SVC_CACHE_PREFIX)]:
+        del st.session_state[k]
+
+
+def _select_service(fq_name: str):
+    if st.session_state.get("selected_cortex_search_service") != fq_name:
+        _clear_svc_handles()
+    st.session_state.selected_cortex_search_service = fq_name
+
+
 def intersect_preserving_order_caseaware(candidates: List[str], allowed: List[str]) -> List[str]:
     allowed_map = {a.lower(): a for a in allowed}
     out: List[str] = []
@@ -160,13 +241,27 @@ def intersect_preserving_order_caseaware(candidates: List[str], allowed: List[st
     return out
 
 
-def describe_cortex_service_properties(db: str, schema: str, short_name: str) -> Dict[str, str]:
+def build_request_columns(columns: List[str], search_col: str, columns_available: List[str]) -> List[str]:
+    request_columns = intersect_preserving_order_caseaware(columns, columns_available)
+    allowed_map = {a.lower(): a for a in columns_available}
+    if search_col.lower() not in [c.lower() for c in request_columns]:
+        request_columns = [allowed_map.get(search_col.lower(), search_col)] + request_columns
+    return request_columns
+
+
+def with_request_columns(meta: Dict[str, Any]) -> Dict[str, Any]:
+    # 毎ターン不変な検索列をサービス情報に前計算しておく
+    search_col = meta.get("search_column") or "chunk"
+    columns_available = meta.get("columns_available", []) or []
+    meta["default_request_columns"] = build_request_columns(DEFAULT_REQUEST_COLUMNS, search_col, columns_available)
+    return meta
+
+
+def fetch_cortex_service_properties(session, db: str, schema: str, short_name: str) -> Dict[str, str]:
     try:
         fq = f"{quote_ident(db)}.{quote_ident(schema)}.{quote_ident(short_name)}"
         df = session.sql(f"DESCRIBE CORTEX SEARCH SERVICE {fq};")
-        rows = df.collect()
-        cols = [f.name for f in df.schema.fields]
-        dicts = df_rows_to_dicts(rows, cols)
+        dicts = df_rows_to_dicts(df)
         props: Dict[str, str] = {}
         for rd in dicts:
             key = (rd.get("property") or rd.get("key") or rd.get("name") or "").strip().upper()
@@ -178,76 +273,111 @@ def describe_cortex_service_properties(db: str, schema: str, short_name: str) ->
         return {}
 
 
-def get_distinct_values_for_column(meta: Dict[str, Any], column: str, max_values: int = 200) -> List[str]:
-    # 1) DESCRIBE 情報からターゲットを推定して DISTINCT
-    if not meta or not column:
-        return []
-    db = meta.get("db", "")
-    schema = meta.get("schema", "")
-    short_name = meta.get("short_name", "") or meta.get("fq_name", "").split(".")[-1]
-    props = describe_cortex_service_properties(db, schema, short_name)
+@st.cache_data(ttl=600, show_spinner=False)
+def describe_cortex_service_properties(db: str, schema: str, short_name: str) -> Dict[str, str]:
+    return fetch_cortex_service_properties(get_session(), db, schema, short_name)
 
+
+def build_distinct_sql(props: Dict[str, str], column: str, max_values: int = DISTINCT_LIMIT) -> str:
     source_table = props.get("TARGET_TABLE") or props.get("SOURCE_TABLE") or ""
     query_text = props.get("QUERY") or props.get("STATEMENT_TEXT") or ""
 
     col = quote_ident(column)
-    sql = ""
-    if source_table:
-        sql = f"SELECT DISTINCT TO_VARCHAR({col}) AS V FROM {source_table} WHERE {col} IS NOT NULL ORDER BY 1 LIMIT {max_values}"
-    elif query_text:
-        qt = query_text.strip().rstrip(";")
-        sql = f"WITH BASE AS ({qt}) SELECT DISTINCT TO_VARCHAR({col}) AS V FROM BASE WHERE {col} IS NOT NULL ORDER BY 1 LIMIT {max_values}"
-
-    if sql:
-        try:
-            df = session.sql(sql)
-            rows = df.collect()
-            values = []
-            for r in rows:
-                v = r[0]
-                if v is None:
-                    continue
-                s = str(v).strip()
-                if s not in values:
-                    values.append(s)
-            if values:
-                return values
-        except Exception:
-            pass
+    prefix = ""
+    source = source_table.strip()
+    if not source and query_text:
+        prefix = f"WITH BASE AS ({query_text.strip().rstrip(';')}) "
+        source = "BASE"
+    if not source:
+        return ""
+    return f"{prefix}SELECT DISTINCT TO_VARCHAR({col}) AS V FROM {source} WHERE {col} IS NOT NULL ORDER BY 1 LIMIT {int(max_values)}"
+
+
+def fetch_distinct_values(session, sql: str) -> List[str]:
+    try:
+        v = session.sql(sql).to_pandas()["V"].dropna().astype(str).str.strip()
+        return list(dict.fromkeys(v.tolist()))
+    except Exception:
+        return []
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def prefetch_distinct_values(
+    db: str,
+    schema: str,
+    short_name: str,
+    columns: Tuple[str, ...],
+    max_values: int = DISTINCT_LIMIT,
+    _props: Optional[Dict[str, str]] = None,
+) -> Dict[str, List[str]]:
+    # 複数列の DISTINCT を同時に発行し、列切り替え時はキャッシュから即時に返す
+    # （_props は先頭の "_" によりキャッシュキーから除外。キーは安定したプリミティブのみ）
+    props = _props or describe_cortex_service_properties(db, schema, short_name)
+    sqls = {c: build_distinct_sql(props, c, max_values) for c in columns if c}
+    sqls = {c: q for c, q in sqls.items() if q}
+    if not sqls:
+        return {}
+    session = get_session()
+    with ThreadPoolExecutor(max_workers=min(8, len(sqls))) as ex:
+        futures = {c: ex.submit(fetch_distinct_values, session, q) for c, q in sqls.items()}
+    return {c: fut.result() for c, fut in futures.items()}
+
+
+def get_distinct_values_for_column(
+    db: str,
+    schema: str,
+    short_name: str,
+    column: str,
+    max_values: int = DISTINCT_LIMIT,
+    props: Optional[Dict[str, str]] = None,
+    prefetch_columns: Tuple[str, ...] = (),
+) -> List[str]:
+    # 1) DESCRIBE 情報からターゲットを推定して DISTINCT（サービス一覧取得時の結果があれば再利用）
+    if not short_name or not column:
+        return []
+    columns = prefetch_columns if column in prefetch_columns else (column,)
+    values = prefetch_distinct_values(db, schema, short_name, columns, max_values, _props=props).get(column)
+    if values:
+        return values
 
     # 2) フォールバック: サービス検索のサンプルから推定（上位N件）
-    return get_distinct_values_via_search(meta, column, sample_size=max_values)
+    return get_distinct_values_via_search(db, schema, short_name, column, sample_size=max_values)
 
 
-def get_distinct_values_via_search(meta: Dict[str, Any], column: str, sample_size: int = 200) -> List[str]:
+@st.cache_data(ttl=600, show_spinner=False)
+def get_distinct_values_via_search(db: str, schema: str, short_name: str, column: str, sample_size: int = DISTINCT_LIMIT) -> List[str]:
     try:
-        db = meta.get("db", "")
-        schema = meta.get("schema", "")
-        short_name = meta.get("short_name", "") or meta.get("fq_name", "").split(".")[-1]
-        svc = root.databases[db].schemas[schema].cortex_search_services[short_name]
+        svc = get_svc_handle(db, schema, short_name)
 
         # いくつかのクエリで試行（空/ワイルドカード/汎用語）
         queries_to_try = ["", "*", "a", "the", "の"]
         seen: set[str] = set()
         values: List[str] = []
+        column_l = column.lower()
 
-        for q in queries_to_try:
-            try:
-                doc = svc.search(q, columns=[column], limit=sample_size)
-                for r in doc.results:
-                    val = r.get(column) or r.get(column.lower()) or r.get(column.upper())
-                    if val is None:
-                        continue
-                    s = str(val).strip()
-                    if s and s not in seen:
-                        seen.add(s)
-                        values.append(s)
-                        if len(values) >= sample_size:
-                            break
-                if values:
-                    break
-            except Exception:
-                continue
+        # 各クエリは独立した HTTP 往復なので同時に発行し、結果は試行順に採用
+        ex = ThreadPoolExecutor(max_workers=len(queries_to_try))
+        futures = [ex.submit(svc.search, q, columns=[column], limit=sample_size) for q in queries_to_try]
+        try:
+            for fut in futures:
+                try:
+                    doc = fut.result()
+                    for r in doc.results:
+                        val = {str(k).lower(): v for k, v in r.items()}.get(column_l)
+                        if val is None:
+                            continue
+                        s = str(val).strip()
+                        if s and s not in seen:
+                            seen.add(s)
+                            values.append(s)
+                            if len(values) >= sample_size:
+                                break
+                    if values:
+                        break
+                except Exception:
+                    continue
+        finally:
+            ex.shutdown(wait=False, cancel_futures=True)
 
         return values
     except Exception:
@@ -256,6 +386,101 @@ def get_distinct_values_via_search(meta: Dict[str, Any], column: str, sample_siz
 
 # ---------- サイドバー ----------
 
+# st.fragment（Streamlit 1.37+）が無い環境では通常の関数として扱う
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
+
+
+@_fragment
+def render_filter_controls():
+    # フィルタ（任意カラム=値, 値は DISTINCT 実データ or 手入力）
+    meta = st.session_state.get("selected_cortex_meta") or {}
+    columns_available: List[str] = meta.get("columns_available", []) or []
+
+    if "filter_enabled" not in st.session_state:
+        st.session_state.filter_enabled = False
+    if "filter_column" not in st.session_state:
+        st.session_state.filter_column = columns_available[0] if columns_available else ""
+    else:
+        if columns_available and st.session_state.filter_column not in columns_available:
+            st.session_state.filter_column = columns_available[0]
+
+    if "filter_value_options" not in st.session_state:
+        st.session_state.filter_value_options = []
+    if "filter_value_selected_key" not in st.session_state:
+        st.session_state.filter_value_selected_key = ""
+    if "filter_value_manual" not in st.session_state:
+        st.session_state.filter_value_manual = ""
+
+    st.session_state.filter_enabled = st.toggle(
+        "フィルタを使う（@eq）",
+        value=st.session_state.filter_enabled,
+        help="選択した列が値と完全一致のデータのみ検索します。"
+    )
+    if st.session_state.filter_enabled:
+        st.session_state.filter_column = st.selectbox(
+            "フィルタ列",
+            options=columns_available if columns_available else [""],
+            index=(columns_available.index(st.session_state.filter_column) if st.session_state.filter_column in columns_available else 0),
+            disabled=not columns_available,
+            help="Cortex Search Serviceが保持するメタデータ列から選択"
+        )
+
+        # サービス/列の変更検知
+        cur = (st.session_state.selected_cortex_search_service or "", st.session_state.filter_column or "")
+        changed = st.session_state.get("_last_sidebar_tuple") != cur
+        if changed:
+            st.session_state["_last_sidebar_tuple"] = cur
+
+        # 値の再取得
+        refresh_clicked = st.button("値を再取得")
+        if refresh_clicked:
+            prefetch_distinct_values.clear()
+            get_distinct_values_via_search.clear()
+            describe_cortex_service_properties.clear()
+            # サービス一覧側に保持した DESCRIBE 結果も最新化（次回以降の列切り替えでも同じ値を使う）
+            load_cortex_services.clear()
+            meta["props"] = describe_cortex_service_properties(
+                meta.get("db", ""),
+                meta.get("schema", ""),
+                meta.get("short_name", "") or meta.get("fq_name", "").split(".")[-1],
+            )
+        if changed or refresh_clicked:
+            # 検索列（チャンク本文）の DISTINCT は全件スキャンになるため先読みしない
+            search_col_l = (meta.get("search_column") or "chunk").lower()
+            prefetch_columns = tuple(c for c in columns_available if c.lower() != search_col_l)
+            st.session_state.filter_value_options = get_distinct_values_for_column(
+                meta.get("db", ""),
+                meta.get("schema", ""),
+                meta.get("short_name", "") or meta.get("fq_name", "").split(".")[-1],
+                st.session_state.filter_column,
+                props=meta.get("props"),
+                prefetch_columns=prefetch_columns,
+            )
+            # 選択キー初期化
+            st.session_state.filter_value_selected_key = ""
+            st.session_state.filter_value_manual = ""
+
+        opts = ["", MANUAL_SENTINEL] + st.session_state.filter_value_options
+        st.session_state.filter_value_selected_key = st.selectbox(
+            f"フィルタ値（DISTINCT 上位{DISTINCT_LIMIT}件）",
+            options=opts,
+            index=opts.index(st.session_state.filter_value_selected_key) if st.session_state.filter_value_selected_key in opts else 0,
+            format_func=lambda v: "（指定しない）" if v == "" else (v if v != MANUAL_SENTINEL else "＜手入力＞"),
+        )
+
+        if st.session_state.filter_value_selected_key == MANUAL_SENTINEL:
+            st.session_state.filter_value_manual = st.text_input(
+                "手入力フィルタ値",
+                value=st.session_state.filter_value_manual,
+                placeholder="例: Japanese",
+            )
+
+        if not columns_available:
+            st.info("このサービスに列情報が見つかりません。サービス定義をご確認ください。")
+        elif not st.session_state.filter_value_options and st.session_state.filter_value_selected_key != MANUAL_SENTINEL:
+            st.info("候補値が取得できませんでした。必要に応じて＜手入力＞を使ってください。")
+
+
 def init_sidebar():
     st.sidebar.header("設定")
 
@@ -265,7 +490,14 @@ def init_sidebar():
     if "schema_hint" not in st.session_state:
         st.session_state.schema_hint = ""
 
-    databases = list_databases()
+    if st.sidebar.button("🔄 メタデータを更新"):
+        _clear_metadata_cache()
+        _clear_svc_handles()
+
+    # 既定DBが使えるうちは SHOW DATABASES を省略し、必要時のみ全件を取得
+    quick_db = bool(DB_HINT_DEFAULT) and _db_reachable(DB_HINT_DEFAULT)
+    show_all_dbs = quick_db and st.sidebar.checkbox("他のDBを表示", key="_show_all_dbs")
+    databases = [DB_HINT_DEFAULT] if quick_db and not show_all_dbs else list_databases()
     db_options = [""] + databases
     default_db = st.session_state.db_hint if st.session_state.db_hint in db_options else (
         DB_HINT_DEFAULT if DB_HINT_DEFAULT in databases else ""
@@ -301,20 +533,20 @@ def init_sidebar():
         manual = st.sidebar.text_input('完全修飾名（例: CORTEX_SEARCH_SAMPLE.PUBLIC."JPI_SEARCH_SERVICE"）')
         if manual:
             parts = manual.split(".")
-            st.session_state.selected_cortex_search_service = manual
-            st.session_state.selected_cortex_meta = {
+            _select_service(manual)
+            st.session_state.selected_cortex_meta = with_request_columns({
                 "fq_name": manual,
                 "db": parts[0] if len(parts) > 0 else "",
                 "schema": parts[1] if len(parts) > 1 else "",
                 "short_name": parts[-1].strip('"'),
                 "search_column": "chunk",
                 "columns_available": ["chunk", "relative_path", "file_url", "language"],
-            }
+            })
         return
 
     options = [s["fq_name"] for s in services]
     chosen = st.sidebar.selectbox("Cortex Search Service（完全修飾名）", options, index=0)
-    st.session_state.selected_cortex_search_service = chosen
+    _select_service(chosen)
     st.session_state.selected_cortex_meta = next((s for s in services if s["fq_name"] == chosen), None)
 
     st.sidebar.divider()
@@ -327,77 +559,9 @@ def init_sidebar():
 
     st.sidebar.divider()
 
-    # フィルタ（任意カラム=値, 値は DISTINCT 実データ or 手入力）
-    meta = st.session_state.get("selected_cortex_meta") or {}
-    columns_available: List[str] = meta.get("columns_available", []) or []
-
-    if "filter_enabled" not in st.session_state:
-        st.session_state.filter_enabled = False
-    if "filter_column" not in st.session_state:
-        st.session_state.filter_column = columns_available[0] if columns_available else ""
-    else:
-        if columns_available and st.session_state.filter_column not in columns_available:
-            st.session_state.filter_column = columns_available[0]
-
-    if "filter_value_options" not in st.session_state:
-        st.session_state.filter_value_options = []
-    if "filter_value_selected_key" not in st.session_state:
-        st.session_state.filter_value_selected_key = ""
-    if "filter_value_manual" not in st.session_state:
-        st.session_state.filter_value_manual = ""
-
-    st.session_state.filter_enabled = st.sidebar.toggle(
-        "フィルタを使う（@eq）",
-        value=st.session_state.filter_enabled,
-        help="選択した列が値と完全一致のデータのみ検索します。"
-    )
-    if st.session_state.filter_enabled:
-        st.session_state.filter_column = st.sidebar.selectbox(
-            "フィルタ列",
-            options=columns_available if columns_available else [""],
-            index=(columns_available.index(st.session_state.filter_column) if st.session_state.filter_column in columns_available else 0),
-            disabled=not columns_available,
-            help="Cortex Search Serviceが保持するメタデータ列から選択"
-        )
-
-        # サービス/列の変更検知
-        svc_key = st.session_state.selected_cortex_search_service or ""
-        col_key = st.session_state.filter_column or ""
-        changed = False
-        if st.session_state.get("_last_service_key") != svc_key:
-            st.session_state["_last_service_key"] = svc_key
-            changed = True
-        if st.session_state.get("_last_filter_column") != col_key:
-            st.session_state["_last_filter_column"] = col_key
-            changed = True
-
-        # 値の再取得
-        refresh_clicked = st.sidebar.button("値を再取得")
-        if changed or refresh_clicked:
-            st.session_state.filter_value_options = get_distinct_values_for_column(meta, st.session_state.filter_column)
-            # 選択キー初期化
-            st.session_state.filter_value_selected_key = ""
-            st.session_state.filter_value_manual = ""
-
-        opts = ["", MANUAL_SENTINEL] + st.session_state.filter_value_options
-        st.session_state.filter_value_selected_key = st.sidebar.selectbox(
-            "フィルタ値（DISTINCT 上位200件）",
-            options=opts,
-            index=opts.index(st.session_state.filter_value_selected_key) if st.session_state.filter_value_selected_key in opts else 0,
-            format_func=lambda v: "（指定しない）" if v == "" else (v if v != MANUAL_SENTINEL else "＜手入力＞"),
-        )
-
-        if st.session_state.filter_value_selected_key == MANUAL_SENTINEL:
-            st.session_state.filter_value_manual = st.sidebar.text_input(
-                "手入力フィルタ値",
-                value=st.session_state.filter_value_manual,
-                placeholder="例: Japanese",
-            )
-
-        if not columns_available:
-            st.sidebar.info("このサービスに列情報が見つかりません。サービス定義をご確認ください。")
-        elif not st.session_state.filter_value_options and st.session_state.filter_value_selected_key != MANUAL_SENTINEL:
-            st.sidebar.info("候補値が取得できませんでした。必要に応じて＜手入力＞を使ってください。")
+    # フィルタ（操作時はフラグメント内だけ再実行し、チャット履歴は再描画しない）
+    with st.sidebar:
+        render_filter_controls()
 
     st.sidebar.divider()
 
@@ -429,44 +593,56 @@ def init_sidebar():
 
 # ---------- 検索/プロンプト ----------
 
-def query_cortex_search_service(query: str, columns: Optional[List[str]] = None, filter: Optional[Dict[str, Any]] = None):
-    columns = columns or ["chunk", "file_url", "relative_path"]
+def query_cortex_search_service(
+    query: str,
+    columns: Optional[List[str]] = None,
+    filter: Optional[Dict[str, Any]] = None,
+    meta: Optional[Dict[str, Any]] = None,
+    limit: Optional[int] = None,
+    svc=None,
+):
+    # meta/limit/svc を渡せば st.session_state に触れないため、ワーカースレッドからも呼べる
+    columns = columns or DEFAULT_REQUEST_COLUMNS
     filter = filter or {}
 
-    meta = st.session_state.selected_cortex_meta or {}
+    if meta is None:
+        meta = st.session_state.selected_cortex_meta or {}
+    if limit is None:
+        limit = st.session_state.num_retrieved_chunks
     db = meta.get("db", "")
     schema = meta.get("schema", "")
     short_name = meta.get("short_name", "") or meta.get("fq_name", "").split(".")[-1]
     search_col = (meta.get("search_column") or "chunk")
-    columns_available: List[str] = meta.get("columns_available", []) or []
 
-    request_columns = intersect_preserving_order_caseaware(columns, columns_available)
-    allowed_map = {a.lower(): a for a in columns_available}
-    if search_col.lower() not in [c.lower() for c in request_columns]:
-        request_columns = [allowed_map.get(search_col.lower(), search_col)] + request_columns
+    if columns == DEFAULT_REQUEST_COLUMNS and "default_request_columns" in meta:
+        request_columns = meta["default_request_columns"]
+    else:
+        request_columns = build_request_columns(columns, search_col, meta.get("columns_available", []) or [])
 
-    svc = root.databases[db].schemas[schema].cortex_search_services[short_name]
+    if svc is None:
+        svc = get_svc_handle(db, schema, short_name)
 
     doc = svc.search(
         query,
         columns=request_columns,
         filter=filter,
-        limit=st.session_state.num_retrieved_chunks,
+        limit=limit,
     )
     results = doc.results  # List[Dict[str, Any]]
 
     context_rows = []
     lines = []
     search_col_l = search_col.lower()
-    search_col_u = search_col.upper()
     for i, r in enumerate(results, start=1):
-        content = r.get(search_col) or r.get(search_col_l) or r.get(search_col_u) or ""
+        # 列名の大文字/小文字ゆれは行ごとに一度だけ吸収
+        rl = {str(k).lower(): v for k, v in r.items()}
+        content = rl.get(search_col_l) or ""
         context_rows.append({
             "idx": i,
-            "relative_path": r.get("relative_path") or r.get("RELATIVE_PATH"),
-            "file_url": r.get("file_url") or r.get("FILE_URL"),
+            "relative_path": rl.get("relative_path"),
+            "file_url": rl.get("file_url"),
             "chunk": content,
-            "score": r.get("score") or r.get("SCORE"),
+            "score": rl.get("score"),
         })
         lines.append(f"Context document {i}: {content}\n")
 
@@ -474,6 +650,37 @@ def query_cortex_search_service(query: str, columns: Optional[List[str]] = None,
     return context_text, results, context_rows
 
 
+@st.cache_resource
+def _completion_cache() -> Dict[str, Any]:
+    # 同一モデル・同一プロンプトの回答をアプリ内で共有（ストリーミング結果を後から格納）
+    # entries: (model, prompt) -> (text, 格納時刻)
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+
+def get_cached_completion(model: str, prompt: str) -> Optional[str]:
+    cache = _completion_cache()
+    key = (model, prompt)
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry is None:
+            return None
+        text, stored_at = entry
+        if time.monotonic() - stored_at > COMPLETION_CACHE_TTL:
+            del cache["entries"][key]
+            return None
+        cache["entries"].move_to_end(key)
+        return text
+
+
+def put_cached_completion(model: str, prompt: str, text: str):
+    cache = _completion_cache()
+    with cache["lock"]:
+        cache["entries"][(model, prompt)] = (text, time.monotonic())
+        cache["entries"].move_to_end((model, prompt))
+        while len(cache["entries"]) > COMPLETION_CACHE_SIZE:
+            cache["entries"].popitem(last=False)
+
+
 def build_history_text(chat_history: List[Dict[str, Any]], k: int) -> str:
     if k <= 0 or not chat_history:
         return ""
@@ -512,25 +719,15 @@ def build_prompt(history_text: str, context_text: str, user_query: str) -> str:
 def render_context_table_md(context_rows: List[Dict[str, Any]]) -> str:
     if not context_rows:
         return ""
-    md = "| # | PDF | URL | チャンク抜粋 |\n|---:|---|---|---|\n"
+    parts = ["| # | PDF | URL | チャンク抜粋 |", "|---:|---|---|---|"]
     for r in context_rows:
         chunk = r.get("chunk") or ""
         head = (chunk[:160] + "…") if len(chunk) > 160 else chunk
         pdf_disp = (r.get("relative_path") or "").replace("|", "\\|")
         url_disp = (r.get("file_url") or "—").replace("|", "\\|")
         head_disp = head.replace("|", "\\|")
-        md += f'| {r.get("idx","")} | {pdf_disp} | {url_disp} | {head_disp} |\n'
-    return md
-
-
-def stream_write_text(container, full_text: str):
-    # 疑似ストリーミング（段階描画）
-    buf = ""
-    step = 80
-    for i in range(0, len(full_text), step):
-        buf += full_text[i:i+step]
-        container.markdown(buf)
-        time.sleep(0.02)
+        parts.append(f'| {r.get("idx","")} | {pdf_disp} | {url_disp} | {head_disp} |')
+    return "\n".join(parts) + "\n"
 
 
 def render_existing_history():
@@ -581,15 +778,24 @@ def main():
             if eff:
                 filter_obj = {"@eq": {st.session_state["filter_column"]: eff}}
 
-        # 1) 検索 → 文脈生成
-        context_text, _results, context_rows = query_cortex_search_service(
-            user_query,
-            columns=["chunk", "file_url", "relative_path"],
-            filter=filter_obj,
-        )
+        # 1) 検索 → 文脈生成（別スレッドで実行し、その間に 2) を組み立てる）
+        short_name = meta.get("short_name", "") or meta.get("fq_name", "").split(".")[-1]
+        svc = get_svc_handle(meta.get("db", ""), meta.get("schema", ""), short_name)
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            search_future = ex.submit(
+                query_cortex_search_service,
+                user_query,
+                columns=DEFAULT_REQUEST_COLUMNS,
+                filter=filter_obj,
+                meta=meta,
+                limit=st.session_state.num_retrieved_chunks,
+                svc=svc,
+            )
+
+            # 2) 履歴ウィンドウ
+            history_text = build_history_text(st.session_state.get("chat_history", []), st.session_state.history_k)
 
-        # 2) 履歴ウィンドウ
-        history_text = build_history_text(st.session_state.get("chat_history", []), st.session_state.history_k)
+            context_text, _results, context_rows = search_future.result()
 
         # 3) プロンプト生成
         prompt = build_prompt(history_text, context_text, user_query)
@@ -598,12 +804,17 @@ def main():
         model = st.session_state.selected_model
         with st.chat_message("assistant"):
             placeholder = st.empty()
-            try:
-                final_text = Complete(model=model, prompt=prompt)
-            except Exception as e:
-                final_text = f"モデル呼び出しでエラーが発生しました: {e}"
-
-            stream_write_text(placeholder, final_text)
+            final_text = get_cached_completion(model, prompt)
+            if final_text is not None:
+                placeholder.markdown(final_text)
+            else:
+                try:
+                    # トークン単位のストリーミング表示（write_stream は連結済みの全文を返す）
+                    final_text = placeholder.write_stream(Complete(model=model, prompt=prompt, stream=True))
+                    put_cached_completion(model, prompt, final_text)
+                except Exception as e:
+                    final_text = f"モデル呼び出しでエラーが発生しました: {e}"
+                    placeholder.markdown(final_text)
 
             # 参照チャンクを折りたたみで表示
             if context_rows:
@@ -621,12 +832,19 @@ def main():
             "question": user_query,
             "answer": final_text,
             "model": model,
-            "contexts": context_rows,
+            "contexts": [{**r, "chunk": (r.get("chunk") or "")[:HISTORY_CHUNK_CHARS]} for r in context_rows],
         }
         if "chat_history" not in st.session_state:
             st.session_state.chat_history = []
         st.session_state.chat_history.append(turn)
 
+        # 履歴ウィンドウ外のターンは参照コンテキストを破棄し、総ターン数も上限で切る
+        history = st.session_state.chat_history[-MAX_HISTORY:]
+        keep_ctx = max(st.session_state.history_k, 1)
+        for t in history[:-keep_ctx]:
+            t["contexts"] = []
+        st.session_state.chat_history = history
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file